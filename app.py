@@ -1,38 +1,44 @@
 # app.py
-from flask import Flask, jsonify, render_template, send_from_directory, request # Added 'request'
+from flask import Flask, Response, jsonify, render_template, send_from_directory, request # Added 'request'
 import threading
-import time
 import math # Added for mass calculation if needed
 
-# Import the simulation instance and classes from physics.py
-from physics import simulation_instance, BOUNDS_MIN, BOUNDS_MAX, Sphere, Vector3 # Added Sphere, Vector3
+# Import the bounds and classes from physics.py; the simulation itself runs in its own process
+from physics import BOUNDS_MIN, BOUNDS_MAX, Sphere, Vector3 # Added Sphere, Vector3
+from sim_process import SimulationProcess
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 
+_FOUR_THIRDS_PI = 4.0 * math.pi / 3.0 # Sphere volume factor for mass calculation
+
 # --- Simulation Runner ---
-simulation_active = True
-simulation_thread = None
-# Use a lock for modifications to the spheres list to improve thread safety
+# The physics loop runs in a separate process (see sim_process.py) so it never competes
+# with request handling for the GIL.
+simulation_process = SimulationProcess(BOUNDS_MIN, BOUNDS_MAX)
+# Serializes sphere id allocation and the add/delete/reset commands sent to the simulation
 simulation_lock = threading.Lock()
 
-def run_simulation_background():
-    """Function to run the simulation loop in a separate thread."""
-    print("Simulation thread started.")
-    while simulation_active:
-        start_time = time.monotonic()
-        # Acquire lock before stepping (which reads/modifies sphere list)
-        with simulation_lock:
-             simulation_instance.step() # Step modifies sphere positions/velocities
-        # Release lock happens automatically exiting 'with' block
-
-        end_time = time.monotonic()
-        sleep_time = (1.0 / 60.0) - (end_time - start_time)
-        if sleep_time > 0:
-            time.sleep(sleep_time)
-    print("Simulation thread stopped.")
+def _finite_float(value) -> float:
+    """Coerces a JSON number to float; strings, booleans, NaN and infinities are rejected."""
+    if isinstance(value, (str, bool)):
+        raise TypeError("not a number")
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError("not finite")
+    return value
 
 # --- Flask Routes ---
 
+@app.before_request
+def require_simulation():
+    """Starts the physics process on first use and rejects API calls once it has died."""
+    if not request.path.startswith('/api/'):
+        return None
+    simulation_process.start() # No-op once started; needed when served by `flask run` or a WSGI server
+    if not simulation_process.is_alive():
+        return jsonify({"error": "The simulation process is not running."}), 503
+    return None
+
 @app.route('/')
 def index():
     """Serves the main HTML page."""
@@ -46,15 +52,8 @@ def send_static(path):
 @app.route('/api/state')
 def get_state():
     """API endpoint to get the current state of all spheres."""
-    # Acquire lock briefly to safely get the current state
-    with simulation_lock:
-        sphere_state = simulation_instance.get_state() # get_state reads sphere list
-
-    bounds = {
-        'min': BOUNDS_MIN.to_list(),
-        'max': BOUNDS_MAX.to_list()
-    }
-    return jsonify({"spheres": sphere_state, "bounds": bounds})
+    # The physics process serializes its state once per step into shared memory
+    return Response(simulation_process.get_state_json(), mimetype='application/json')
 
 @app.route('/api/reset', methods=['POST'])
 def reset_simulation():
@@ -62,43 +61,41 @@ def reset_simulation():
     print("Resetting simulation...")
     # Acquire lock before modifying the simulation state
     with simulation_lock:
-        simulation_instance.reset()
+        simulation_process.reset()
     return jsonify({"message": "Simulation reset successfully."})
 
 @app.route('/api/add_sphere', methods=['POST'])
 def add_sphere():
     """API endpoint to add a new sphere."""
-    data = request.get_json()
+    data = request.get_json(silent=True) # None on a missing or malformed JSON body
     print(f"Received request to add sphere: {data}")
 
     try:
-        # Basic validation
-        if not all(k in data for k in ('position', 'velocity', 'radius')):
-             raise ValueError("Missing required fields in request data.")
-        if not (isinstance(data['position'], list) and len(data['position']) == 3 and
-                isinstance(data['velocity'], list) and len(data['velocity']) == 3 and
-                isinstance(data['radius'], (int, float))):
-            raise ValueError("Invalid data types or list lengths.")
-
-        pos_list = data['position']
-        vel_list = data['velocity']
-        radius = float(data['radius'])
+        # Extract and coerce in one pass; any missing field, wrong type or list length lands in the except below
+        try:
+            position, velocity = data['position'], data['velocity']
+            if type(position) is not list or type(velocity) is not list:
+                raise TypeError("not a list")
+            px, py, pz = (_finite_float(v) for v in position)
+            vx, vy, vz = (_finite_float(v) for v in velocity)
+            radius = _finite_float(data['radius'])
+        except (TypeError, KeyError, ValueError, OverflowError):
+            raise ValueError("Missing or invalid 'position', 'velocity' or 'radius' fields.") from None
 
         if radius <= 0:
             raise ValueError("Radius must be positive.")
 
-        position = Vector3(pos_list[0], pos_list[1], pos_list[2])
-        velocity = Vector3(vel_list[0], vel_list[1], vel_list[2])
+        position = Vector3(px, py, pz)
+        velocity = Vector3(vx, vy, vz)
 
         # Simple mass calculation (e.g., proportional to volume)
-        mass = (4/3) * math.pi * (radius ** 3) # Assuming density = 1
+        mass = _FOUR_THIRDS_PI * (radius * radius * radius) # Assuming density = 1
         mass = max(0.1, mass) # Ensure minimum mass
 
-        new_sphere = Sphere(position, velocity, radius, mass)
-
-        # Acquire lock before adding to the simulation's sphere list
+        # Acquire lock before allocating the sphere id and queueing it for the simulation
         with simulation_lock:
-            simulation_instance.add_sphere(new_sphere) # Use the existing add_sphere method
+            new_sphere = Sphere(position, velocity, radius, mass)
+            simulation_process.add_sphere(new_sphere) # Use the existing add_sphere method
 
         print(f"Added sphere with ID: {new_sphere.id}")
         return jsonify({"message": "Sphere added successfully", "id": new_sphere.id}), 200
@@ -114,18 +111,17 @@ def add_sphere():
 @app.route('/api/delete_sphere', methods=['POST']) # Using POST for simplicity
 def delete_sphere():
     """API endpoint to delete a sphere by its ID."""
-    data = request.get_json()
+    data = request.get_json(silent=True) # None on a missing or malformed JSON body
     print(f"Received request to delete sphere: {data}")
 
     try:
-        if 'id' not in data or not isinstance(data['id'], int):
+        sphere_id_to_delete = data.get('id') if isinstance(data, dict) else None
+        if not isinstance(sphere_id_to_delete, int):
              raise ValueError("Missing or invalid 'id' field.")
 
-        sphere_id_to_delete = data['id']
-
-        # Acquire lock before removing from the simulation's sphere list
+        # Acquire lock before queueing the removal for the simulation
         with simulation_lock:
-            removed = simulation_instance.remove_sphere_by_id(sphere_id_to_delete)
+            removed = simulation_process.remove_sphere_by_id(sphere_id_to_delete)
 
         if removed:
             print(f"Deleted sphere with ID: {sphere_id_to_delete}")
@@ -144,14 +140,10 @@ def delete_sphere():
 
 # --- Main Execution ---
 if __name__ == '__main__':
-    simulation_active = True
-    simulation_thread = threading.Thread(target=run_simulation_background, daemon=True)
-    simulation_thread.start()
+    simulation_process.start()
 
     print("Starting Flask server...")
     app.run(debug=True, host='0.0.0.0', use_reloader=False)
 
-    simulation_active = False
-    if simulation_thread:
-        simulation_thread.join(timeout=1.0)
+    simulation_process.stop(timeout=1.0)
     print("Flask server stopped.")
\ No newline at end of file
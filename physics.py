@@ -1,11 +1,40 @@
 # physics.py
+import collections
+import json
 import math
-import random
 import time
 
+import numpy as np
+
+from physics_constants import BVH_STACK_SIZE, FIXED_DT, kernels_version
+
+
+def _load_aot_kernel():
+    """Returns the ahead-of-time compiled kernel (built by physics_kernels_build.py, no JIT warm-up),
+    or None if it is missing or was built from other kernel sources."""
+    try:
+        import _physics_kernels_aot
+    except ImportError:
+        return None
+    # Builds that predate the version export have no kernels_version
+    built_version = getattr(_physics_kernels_aot, 'kernels_version', None)
+    if built_version is None or built_version() != kernels_version():
+        print("Physics: _physics_kernels_aot is out of date, using the JIT kernel. "
+              "Rebuild it with: python physics_kernels_build.py")
+        return None
+    return _physics_kernels_aot.simulate_substeps
+
+
+simulate_substeps = _load_aot_kernel()
+if simulate_substeps is None:
+    from physics_kernels import simulate_substeps
+
+_FOUR_THIRDS_PI = 4.0 * math.pi / 3.0 # Sphere volume factor, mass = density * volume
+
 # --- Vector3 Class (remains the same) ---
 class Vector3:
     # ... (no changes needed here) ...
+    __slots__ = ('x', 'y', 'z')
     def __init__(self, x=0.0, y=0.0, z=0.0):
         self.x = float(x)
         self.y = float(y)
@@ -15,15 +44,18 @@ class Vector3:
     def __mul__(self, scalar): return Vector3(self.x * scalar, self.y * scalar, self.z * scalar)
     def __truediv__(self, scalar): return Vector3(self.x / scalar, self.y / scalar, self.z / scalar) if scalar != 0 else Vector3()
     def magnitude_sq(self): return self.x*self.x + self.y*self.y + self.z*self.z
-    def magnitude(self): return math.sqrt(self.magnitude_sq())
+    def magnitude(self): return self.magnitude_sq() ** 0.5
     def normalize(self): mag = self.magnitude(); return self / mag if mag != 0 else Vector3()
     def dot(self, other): return self.x * other.x + self.y * other.y + self.z * other.z
     def to_list(self): return [self.x, self.y, self.z]
     def __repr__(self): return f"Vector3({self.x:.2f}, {self.y:.2f}, {self.z:.2f})"
 
 
-# --- Sphere Class (remains the same) ---
+# --- Sphere Class ---
+# Plain record used at the API boundary; the simulation itself keeps sphere
+# state in parallel NumPy arrays (see Simulation).
 class Sphere:
+    __slots__ = ('id', 'position', 'velocity', 'radius', 'mass', 'inv_mass')
     _id_counter = 0
     def __init__(self, position: Vector3, velocity: Vector3, radius: float, mass: float):
         self.id = Sphere._id_counter
@@ -32,172 +64,184 @@ class Sphere:
         self.velocity = velocity
         self.radius = max(0.1, float(radius))
         self.mass = max(0.1, float(mass))
-
-    def update(self, dt: float):
-        self.position += self.velocity * dt
-
-    def get_state(self):
-        return {
-            "id": self.id,
-            "position": self.position.to_list(),
-            "radius": self.radius
-        }
+        self.inv_mass = 1.0 / self.mass
 
 # --- Simulation Class ---
 class Simulation:
     def __init__(self, bounds_min: Vector3, bounds_max: Vector3):
-        self.spheres = []
         self.bounds_min = bounds_min
         self.bounds_max = bounds_max
+        self._bmin = np.array(bounds_min.to_list())
+        self._bmax = np.array(bounds_max.to_list())
+        self._bounds = {'min': bounds_min.to_list(), 'max': bounds_max.to_list()}
+        self._rng = np.random.default_rng()
+        self._clear()
+        self._publish_state()
         self.last_step_time = time.monotonic()
+        self._accum = 0.0 # Real time not yet simulated, always < FIXED_DT after a step
+        self._pending_ops = collections.deque() # (op, payload) commands applied at the start of step()
+        self._alloc_bvh_scratch(0)
+
+    def _clear(self):
+        """Empties the per-sphere arrays (structure-of-arrays layout, one row per sphere)."""
+        self.ids = np.empty(0, dtype=np.int64)
+        self.pos = np.empty((0, 3))
+        self.vel = np.empty((0, 3))
+        self.radius = np.empty(0)
+        self.inv_mass = np.empty(0)
+        self._id_to_idx = {} # sphere id -> row in the arrays above
+
+    def _append(self, ids, pos, vel, radius, inv_mass):
+        """Appends a batch of spheres (one row per sphere) to the arrays."""
+        start = len(self.ids)
+        self._id_to_idx.update(zip(ids.tolist(), range(start, start + len(ids))))
+        self.ids = np.concatenate((self.ids, ids))
+        self.pos = np.concatenate((self.pos, pos))
+        self.vel = np.concatenate((self.vel, vel))
+        self.radius = np.concatenate((self.radius, radius))
+        self.inv_mass = np.concatenate((self.inv_mass, inv_mass))
+
+    def _ensure_bvh_scratch(self, num_spheres: int):
+        """Grows the BVH scratch arrays reused by the kernel when the sphere count outgrows them.
+
+        Capacity doubles on growth, so frequent adds do not reallocate every frame.
+        """
+        if len(self._bvh_order) < num_spheres:
+            self._alloc_bvh_scratch(2 * num_spheres)
+
+    def _alloc_bvh_scratch(self, capacity: int):
+        self._bvh_order = np.empty(capacity, dtype=np.int64)
+        self._bvh_nodes = np.empty((4, 2 * capacity), dtype=np.int64) # rows: left, right, first, count
+        self._bvh_center = np.empty((2 * capacity, 3))
+        self._bvh_radius = np.empty(2 * capacity)
+        self._bvh_key = np.empty(capacity) # Split-axis coordinate of each entry of _bvh_order
+        self._bvh_stack = np.empty(BVH_STACK_SIZE, dtype=np.int64)
 
     def add_sphere(self, sphere: Sphere):
-        """Adds a pre-created sphere object to the simulation."""
-        # Note: Assumes this is called within a lock in app.py
-        self.spheres.append(sphere)
-        print(f"Physics: Added sphere {sphere.id}. Total spheres: {len(self.spheres)}")
+        """Adds a pre-created sphere object to the simulation. Visible in the published state after the next step()."""
+        # Note: Not thread-safe; other threads should use queue_command
+        self._append(np.array([sphere.id]), np.array([sphere.position.to_list()]), np.array([sphere.velocity.to_list()]),
+                     np.array([sphere.radius]), np.array([sphere.inv_mass]))
+        print(f"Physics: Added sphere {sphere.id}. Total spheres: {len(self.ids)}")
 
 
     def remove_sphere_by_id(self, sphere_id: int) -> bool:
-        """Removes a sphere by its ID. Returns True if found and removed, False otherwise."""
-        # Note: Assumes this is called within a lock in app.py
-        initial_length = len(self.spheres)
-        # Use list comprehension for safe removal while iterating conceptually
-        self.spheres = [s for s in self.spheres if s.id != sphere_id]
-        removed = len(self.spheres) < initial_length
-        if removed:
-             print(f"Physics: Removed sphere {sphere_id}. Total spheres: {len(self.spheres)}")
-        return removed
-
-    def _handle_wall_collisions(self, sphere: Sphere, dt: float):
-        # ... (remains the same) ...
-        min_pos = self.bounds_min + Vector3(sphere.radius, sphere.radius, sphere.radius)
-        max_pos = self.bounds_max - Vector3(sphere.radius, sphere.radius, sphere.radius)
-        damp = 0.9 # Damping factor on wall collision
-
-        if sphere.position.x < min_pos.x:
-            sphere.position.x = min_pos.x
-            sphere.velocity.x *= -damp
-        elif sphere.position.x > max_pos.x:
-            sphere.position.x = max_pos.x
-            sphere.velocity.x *= -damp
-
-        if sphere.position.y < min_pos.y:
-            sphere.position.y = min_pos.y
-            sphere.velocity.y *= -damp
-        elif sphere.position.y > max_pos.y:
-            sphere.position.y = max_pos.y
-            sphere.velocity.y *= -damp
-
-        if sphere.position.z < min_pos.z:
-            sphere.position.z = min_pos.z
-            sphere.velocity.z *= -damp
-        elif sphere.position.z > max_pos.z:
-            sphere.position.z = max_pos.z
-            sphere.velocity.z *= -damp
-
-
-    def _resolve_sphere_collision(self, s1: Sphere, s2: Sphere):
-        # ... (remains the same - basic elastic collision) ...
-         collision_normal = s1.position - s2.position
-         distance_sq = collision_normal.magnitude_sq()
-         min_dist = s1.radius + s2.radius
-         min_dist_sq = min_dist * min_dist
-
-         if distance_sq <= 1e-9 or distance_sq >= min_dist_sq: # Added epsilon for near-zero dist
-             return
-
-         distance = math.sqrt(distance_sq)
-         collision_normal /= distance # Normalize
-
-         # Resolve Overlap
-         overlap = min_dist - distance
-         inv_mass1 = 1.0 / s1.mass
-         inv_mass2 = 1.0 / s2.mass
-         inv_mass_sum = inv_mass1 + inv_mass2
-         if inv_mass_sum > 1e-9:
-             correction_ratio1 = inv_mass1 / inv_mass_sum
-             correction_ratio2 = inv_mass2 / inv_mass_sum
-             s1.position += collision_normal * (overlap * correction_ratio1)
-             s2.position -= collision_normal * (overlap * correction_ratio2)
-         else: # Handle case of effectively infinite masses
-              s1.position += collision_normal * (overlap * 0.5)
-              s2.position -= collision_normal * (overlap * 0.5)
-
-         # Resolve Velocity
-         relative_velocity = s1.velocity - s2.velocity
-         vel_along_normal = relative_velocity.dot(collision_normal)
-         if vel_along_normal > 0:
-             return
-         e = 1.0 # Elastic
-         j = -(1 + e) * vel_along_normal
-         if inv_mass_sum > 1e-9:
-             j /= inv_mass_sum
-         else:
-             j = 0 # No impulse if total mass is infinite
-
-         impulse = collision_normal * j
-         s1.velocity += impulse * inv_mass1
-         s2.velocity -= impulse * inv_mass2
-
+        """Removes a sphere by its ID. Returns True if found and removed, False otherwise.
+
+        Like add_sphere, the change is published by the next step(), so removal stays O(1).
+        """
+        # Note: Not thread-safe; other threads should use queue_command
+        idx = self._id_to_idx.pop(sphere_id, None)
+        if idx is None:
+            return False
+
+        # Swap-and-pop: move the last row into the freed slot, then drop the last row
+        last = len(self.ids) - 1
+        if idx != last:
+            for arr in (self.ids, self.pos, self.vel, self.radius, self.inv_mass):
+                arr[idx] = arr[last]
+            self._id_to_idx[int(self.ids[idx])] = idx
+        self.ids = self.ids[:last]
+        self.pos = self.pos[:last]
+        self.vel = self.vel[:last]
+        self.radius = self.radius[:last]
+        self.inv_mass = self.inv_mass[:last]
+        print(f"Physics: Removed sphere {sphere_id}. Total spheres: {len(self.ids)}")
+        return True
+
+    def queue_command(self, op: str, payload):
+        """Queues ('add', Sphere), ('delete', sphere id) or ('reset', reset Simulation) for the next step.
+
+        Safe to call from any thread without a lock: deque.append and popleft are atomic.
+        """
+        self._pending_ops.append((op, payload))
+
+    def _apply_pending_ops(self) -> bool:
+        """Applies every queued command. Returns True if any was applied (the state needs publishing)."""
+        applied = False
+        while self._pending_ops:
+            applied = True
+            op, payload = self._pending_ops.popleft()
+            if op == 'add':
+                self.add_sphere(payload)
+            elif op == 'delete':
+                self.remove_sphere_by_id(payload)
+            elif op == 'reset':
+                # Adopt the sphere arrays of a simulation that was reset elsewhere
+                self.ids, self.pos, self.vel = payload.ids, payload.pos, payload.vel
+                self.radius, self.inv_mass = payload.radius, payload.inv_mass
+                self._id_to_idx = payload._id_to_idx
+                self.last_step_time = time.monotonic()
+                self._accum = 0.0
+        return applied
 
     def step(self):
-        """Advances the simulation by one time step."""
-        # Note: Assumes this is called within a lock in app.py
+        """Advances the simulation by the whole fixed-size frames that fit in the elapsed real time."""
+        # Note: Called from the simulation process loop in sim_process.py
+        # Commands do not publish on their own; the state is published once below
+        changed = self._apply_pending_ops()
+
         current_time = time.monotonic()
-        dt = current_time - self.last_step_time
+        # Cap the catch-up after a stall at two frames instead of simulating a huge step
+        self._accum += min(current_time - self.last_step_time, 2 * FIXED_DT)
         self.last_step_time = current_time
-        dt = min(dt, 1.0 / 30.0)
-
-        if dt <= 0: return
-
-        num_sub_steps = 5
-        sub_dt = dt / num_sub_steps
-
-        for _ in range(num_sub_steps):
-            for sphere in self.spheres:
-                sphere.update(sub_dt) # Update position first
 
-            for sphere in self.spheres:
-                self._handle_wall_collisions(sphere, sub_dt) # Handle wall bounds
-
-            num_spheres = len(self.spheres) # Check collisions
-            for i in range(num_spheres):
-                for j in range(i + 1, num_spheres):
-                     # Ensure spheres still exist (might have been removed between API calls)
-                     # This check is less critical now with locking, but doesn't hurt
-                     if self.spheres[i] and self.spheres[j]:
-                          self._resolve_sphere_collision(self.spheres[i], self.spheres[j])
-
-
-    def get_state(self):
-        """Returns the state of all spheres."""
-        # Note: Assumes this is called within a lock in app.py
-        return [s.get_state() for s in self.spheres]
+        num_frames = int(self._accum / FIXED_DT)
+        if num_frames == 0:
+            if changed:
+                self._publish_state()
+            return
+        self._accum -= num_frames * FIXED_DT
+
+        # All frames and their sub-steps run inside one compiled call
+        self._ensure_bvh_scratch(len(self.ids))
+        simulate_substeps(self.pos, self.vel, self.radius, self.inv_mass, num_frames, FIXED_DT,
+                          self._bmin, self._bmax, self._bvh_order, self._bvh_nodes, self._bvh_center, self._bvh_radius,
+                          self._bvh_key, self._bvh_stack)
+        self._publish_state()
+
+
+    def _publish_state(self):
+        """Serializes the current state to JSON once and swaps it in with a single reference assignment."""
+        spheres = [
+            {"id": sphere_id, "position": position, "radius": radius}
+            for sphere_id, position, radius in zip(self.ids.tolist(), self.pos.tolist(), self.radius.tolist())
+        ]
+        self._state_json = json.dumps({"spheres": spheres, "bounds": self._bounds}, separators=(',', ':')).encode()
+
+    def get_state_json(self) -> bytes:
+        """Returns the last published state (spheres and bounds) as a JSON document.
+
+        Safe to call without the lock: the bytes are replaced, never mutated, so readers
+        see either the previous or the new snapshot.
+        """
+        return self._state_json
 
     def reset(self):
         """Resets the simulation to an initial state."""
-        # Note: Assumes this is called within a lock in app.py
+        # Note: Runs on a throwaway Simulation in SimulationProcess.reset(); the live one adopts it via queue_command
         Sphere._id_counter = 0
-        self.spheres = []
+        self._clear()
         self.last_step_time = time.monotonic()
+        self._accum = 0.0
         # Add initial spheres
         self.add_sphere(Sphere(Vector3(-5, 0, 0), Vector3(15, 5, 2), 1.0, 1.0))
         self.add_sphere(Sphere(Vector3(5, 1, -1), Vector3(-10, 2, -3), 1.5, 3.375)) # Mass ~ R^3
         self.add_sphere(Sphere(Vector3(0, -6, 2), Vector3(2, 10, 0), 0.8, 0.512))
         self.add_sphere(Sphere(Vector3(0, 6, -2), Vector3(-3, -12, 5), 1.2, 1.728))
-        for _ in range(6):
-             pos = Vector3(random.uniform(self.bounds_min.x+1, self.bounds_max.x-1),
-                           random.uniform(self.bounds_min.y+1, self.bounds_max.y-1),
-                           random.uniform(self.bounds_min.z+1, self.bounds_max.z-1))
-             vel = Vector3(random.uniform(-8, 8), random.uniform(-8, 8), random.uniform(-8, 8))
-             radius = random.uniform(0.3, 0.8)
-             mass = max(0.1, (4/3) * math.pi * (radius**3))
-             self.add_sphere(Sphere(pos, vel, radius, mass))
-
-# --- Simulation Singleton ---
+
+        # Random spheres, generated in one batch
+        num_random = 6
+        first_id = Sphere._id_counter
+        Sphere._id_counter += num_random
+        pos = self._rng.uniform(self._bmin + 1, self._bmax - 1, size=(num_random, 3))
+        vel = self._rng.uniform(-8, 8, size=(num_random, 3))
+        radius = self._rng.uniform(0.3, 0.8, size=num_random)
+        mass = np.maximum(0.1, _FOUR_THIRDS_PI * (radius * radius * radius))
+        self._append(np.arange(first_id, first_id + num_random), pos, vel, radius, 1.0 / mass)
+        self._publish_state()
+        print(f"Physics: Added {num_random} random spheres. Total spheres: {len(self.ids)}")
+
+# --- Simulation Bounds ---
 BOUNDS_MIN = Vector3(-15, -10, -15)
 BOUNDS_MAX = Vector3(15, 10, 15)
-simulation_instance = Simulation(BOUNDS_MIN, BOUNDS_MAX)
-# No initial reset here, let the reset route handle it or do it after thread start if needed.
-# Initial state will be empty until first reset or add.
\ No newline at end of file
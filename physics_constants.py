@@ -0,0 +1,18 @@
+# physics_constants.py
+# Constants physics.py needs without importing the Numba kernels, so it can run on the
+# ahead-of-time compiled kernel without numba. The frame time is passed to the kernel as an
+# argument; constants frozen into the compiled code stay in physics_kernels.py, where
+# editing them also invalidates Numba's on-disk cache.
+import hashlib
+import os
+
+FIXED_DT = 1.0 / 60.0 # Simulated time per frame
+BVH_STACK_SIZE = 64 # Traversal stack entries; the median split keeps the tree depth near log2(N)
+
+
+
+def kernels_version() -> int:
+    """Hash of physics_kernels.py, compiled into the AOT extension to detect a stale build."""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'physics_kernels.py'), 'rb') as f:
+        digest = hashlib.sha256(f.read())
+    return int(digest.hexdigest()[:15], 16) # Fits in an int64
@@ -0,0 +1,324 @@
+# physics_kernels.py
+# Numba-compiled hot paths of the simulation. They work directly on the
+# structure-of-arrays state held by physics.Simulation (float64 arrays, one row per sphere).
+import math
+
+from numba import njit
+
+# Frozen into the compiled code. They are defined here rather than imported, because Numba
+# only invalidates its on-disk cache when this file changes.
+NUM_SUB_STEPS = 5 # Sub-steps per frame, to reduce tunneling between collision checks
+WALL_DAMPING = 0.9 # Velocity factor kept on wall collision
+# From this many spheres the BVH broadphase replaces the all-pairs test
+BVH_MIN_SPHERES = 64
+BVH_LEAF_SIZE = 4 # Max spheres per BVH leaf
+
+
+@njit(cache=True, fastmath=True)
+def integrate(pos, vel, dt):
+    """Explicit Euler position update for every sphere."""
+    for i in range(pos.shape[0]):
+        for k in range(3):
+            pos[i, k] += vel[i, k] * dt
+
+
+@njit(cache=True, fastmath=True)
+def wall_bounce(pos, vel, radii, bmin, bmax, damp):
+    """Clamps spheres into the bounds and reflects (and damps) the velocity axes that hit a wall."""
+    bmin_x, bmin_y, bmin_z = bmin[0], bmin[1], bmin[2]
+    bmax_x, bmax_y, bmax_z = bmax[0], bmax[1], bmax[2]
+    for i in range(pos.shape[0]):
+        r = radii[i]
+        px, py, pz = pos[i, 0], pos[i, 1], pos[i, 2]
+
+        if px < bmin_x + r:
+            pos[i, 0] = bmin_x + r
+            vel[i, 0] *= -damp
+        elif px > bmax_x - r:
+            pos[i, 0] = bmax_x - r
+            vel[i, 0] *= -damp
+
+        if py < bmin_y + r:
+            pos[i, 1] = bmin_y + r
+            vel[i, 1] *= -damp
+        elif py > bmax_y - r:
+            pos[i, 1] = bmax_y - r
+            vel[i, 1] *= -damp
+
+        if pz < bmin_z + r:
+            pos[i, 2] = bmin_z + r
+            vel[i, 2] *= -damp
+        elif pz > bmax_z - r:
+            pos[i, 2] = bmax_z - r
+            vel[i, 2] *= -damp
+
+
+@njit(cache=True, fastmath=True)
+def resolve_pair(pos, vel, radii, inv_mass, i, j):
+    """Basic elastic collision response between spheres i and j, if they currently overlap."""
+    min_dist = radii[i] + radii[j]
+    min_dist_sq = min_dist * min_dist
+
+    # Per-axis early outs: most candidate pairs are already separated along x or y
+    nx = pos[i, 0] - pos[j, 0]
+    partial_sq = nx * nx
+    if partial_sq >= min_dist_sq:
+        return
+    ny = pos[i, 1] - pos[j, 1]
+    partial_sq += ny * ny
+    if partial_sq >= min_dist_sq:
+        return
+    nz = pos[i, 2] - pos[j, 2]
+    distance_sq = partial_sq + nz * nz
+    if distance_sq <= 1e-9 or distance_sq >= min_dist_sq:
+        return
+
+    distance = math.sqrt(distance_sq)
+    nx /= distance
+    ny /= distance
+    nz /= distance
+
+    # Resolve Overlap
+    overlap = min_dist - distance
+    inv_mass1 = inv_mass[i]
+    inv_mass2 = inv_mass[j]
+    inv_mass_sum = inv_mass1 + inv_mass2
+    if inv_mass_sum > 1e-9:
+        overlap_per_inv_mass = overlap / inv_mass_sum
+        c1 = overlap_per_inv_mass * inv_mass1
+        c2 = overlap_per_inv_mass * inv_mass2
+    else: # Handle case of effectively infinite masses
+        c1 = overlap * 0.5
+        c2 = overlap * 0.5
+    pos[i, 0] += nx * c1
+    pos[i, 1] += ny * c1
+    pos[i, 2] += nz * c1
+    pos[j, 0] -= nx * c2
+    pos[j, 1] -= ny * c2
+    pos[j, 2] -= nz * c2
+
+    # Resolve Velocity (elastic, e = 1)
+    vel_along_normal = ((vel[i, 0] - vel[j, 0]) * nx
+                        + (vel[i, 1] - vel[j, 1]) * ny
+                        + (vel[i, 2] - vel[j, 2]) * nz)
+    if vel_along_normal > 0 or inv_mass_sum <= 1e-9:
+        return
+    j_imp = -2.0 * vel_along_normal / inv_mass_sum
+    j1 = j_imp * inv_mass1
+    j2 = j_imp * inv_mass2
+    vel[i, 0] += nx * j1
+    vel[i, 1] += ny * j1
+    vel[i, 2] += nz * j1
+    vel[j, 0] -= nx * j2
+    vel[j, 1] -= ny * j2
+    vel[j, 2] -= nz * j2
+
+
+@njit(cache=True, fastmath=True)
+def collide_all_pairs(pos, vel, radii, inv_mass):
+    """Tests every unique pair; cheapest for a handful of spheres."""
+    n = pos.shape[0]
+    for i in range(n):
+        for j in range(i + 1, n):
+            resolve_pair(pos, vel, radii, inv_mass, i, j)
+
+
+@njit(cache=True, fastmath=True)
+def _select(order, key, lo, hi, kth):
+    """Partially sorts order[lo:hi] by key in place (quickselect), keeping key in step with order.
+
+    Afterwards order[kth] holds the element of rank kth, with no larger key before it and
+    no smaller key after it.
+    """
+    hi -= 1
+    while lo < hi:
+        pivot = key[(lo + hi) // 2]
+        i = lo
+        j = hi
+        while i <= j:
+            while key[i] < pivot:
+                i += 1
+            while key[j] > pivot:
+                j -= 1
+            if i <= j:
+                key[i], key[j] = key[j], key[i]
+                order[i], order[j] = order[j], order[i]
+                i += 1
+                j -= 1
+        if kth <= j:
+            hi = j
+        elif kth >= i:
+            lo = i
+        else:
+            return
+
+
+@njit(cache=True, fastmath=True)
+def bvh_build(pos, order, left, right, first, count, key, stack):
+    """Top-down BVH build: splits each node at the median of its centroids along the widest axis.
+
+    The tree is stored in flat arrays (SoA). Leaves have left == -1 and own the sphere indices
+    order[first:first + count]. Children are always allocated after their parent. Returns the
+    number of nodes used; node bounds are filled in by bvh_refit. key and stack are scratch
+    space, so the build allocates nothing.
+    """
+    n = pos.shape[0]
+    for i in range(n):
+        order[i] = i
+    first[0] = 0
+    count[0] = n
+    num_nodes = 1
+    stack[0] = 0
+    top = 1
+    while top > 0:
+        top -= 1
+        node = stack[top]
+        start = first[node]
+        size = count[node]
+        if size <= BVH_LEAF_SIZE:
+            left[node] = -1
+            right[node] = -1
+            continue
+
+        # Widest axis of the centroids in this node
+        axis = 0
+        widest = -1.0
+        for k in range(3):
+            lo = math.inf
+            hi = -math.inf
+            for s in range(start, start + size):
+                c = pos[order[s], k]
+                lo = min(lo, c)
+                hi = max(hi, c)
+            if hi - lo > widest:
+                widest = hi - lo
+                axis = k
+
+        # Median split in place: only the partition around the middle is needed, not a full sort
+        for s in range(start, start + size):
+            key[s] = pos[order[s], axis]
+        half = size // 2
+        _select(order, key, start, start + size, start + half)
+
+        left[node] = num_nodes
+        right[node] = num_nodes + 1
+        first[num_nodes] = start
+        count[num_nodes] = half
+        first[num_nodes + 1] = start + half
+        count[num_nodes + 1] = size - half
+        stack[top] = num_nodes
+        stack[top + 1] = num_nodes + 1
+        top += 2
+        num_nodes += 2
+    return num_nodes
+
+
+@njit(cache=True, fastmath=True)
+def bvh_refit(pos, radii, order, left, right, first, count, center, radius, num_nodes):
+    """Recomputes every node's bounding sphere from the current sphere positions, leaves first."""
+    for node in range(num_nodes - 1, -1, -1):
+        if left[node] == -1:
+            # Leaf: centroid of its spheres, radius reaching the farthest sphere surface
+            start = first[node]
+            size = count[node]
+            cx = 0.0
+            cy = 0.0
+            cz = 0.0
+            for s in range(start, start + size):
+                j = order[s]
+                cx += pos[j, 0]
+                cy += pos[j, 1]
+                cz += pos[j, 2]
+            cx /= size
+            cy /= size
+            cz /= size
+            r = 0.0
+            for s in range(start, start + size):
+                j = order[s]
+                dx = pos[j, 0] - cx
+                dy = pos[j, 1] - cy
+                dz = pos[j, 2] - cz
+                r = max(r, math.sqrt(dx * dx + dy * dy + dz * dz) + radii[j])
+        else:
+            # Internal: smallest sphere enclosing both child spheres
+            a = left[node]
+            b = right[node]
+            dx = center[b, 0] - center[a, 0]
+            dy = center[b, 1] - center[a, 1]
+            dz = center[b, 2] - center[a, 2]
+            d = math.sqrt(dx * dx + dy * dy + dz * dz)
+            if d + radius[b] <= radius[a]:
+                cx, cy, cz, r = center[a, 0], center[a, 1], center[a, 2], radius[a]
+            elif d + radius[a] <= radius[b]:
+                cx, cy, cz, r = center[b, 0], center[b, 1], center[b, 2], radius[b]
+            else:
+                r = 0.5 * (d + radius[a] + radius[b])
+                t = (r - radius[a]) / d
+                cx = center[a, 0] + dx * t
+                cy = center[a, 1] + dy * t
+                cz = center[a, 2] + dz * t
+        center[node, 0] = cx
+        center[node, 1] = cy
+        center[node, 2] = cz
+        radius[node] = r
+
+
+@njit(cache=True, fastmath=True)
+def collide_bvh(pos, vel, radii, inv_mass, order, left, right, first, count, center, radius, stack):
+    """Resolves collisions by descending the BVH once per sphere, testing only overlapping nodes."""
+    for i in range(pos.shape[0]):
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            dx = pos[i, 0] - center[node, 0]
+            dy = pos[i, 1] - center[node, 1]
+            dz = pos[i, 2] - center[node, 2]
+            reach = radii[i] + radius[node]
+            if dx * dx + dy * dy + dz * dz >= reach * reach:
+                continue
+            if left[node] == -1:
+                for s in range(first[node], first[node] + count[node]):
+                    j = order[s]
+                    if j > i:
+                        resolve_pair(pos, vel, radii, inv_mass, i, j)
+            else:
+                stack[top] = left[node]
+                stack[top + 1] = right[node]
+                top += 2
+
+
+@njit(cache=True, fastmath=True)
+def simulate_substeps(pos, vel, radii, inv_mass, num_frames, frame_dt, bmin, bmax, order, nodes, center, radius,
+                      key, stack):
+    """Advances num_frames fixed frames of frame_dt, NUM_SUB_STEPS sub-steps each, in a single call.
+
+    Each sub-step integrates, bounces off the walls and resolves sphere collisions. frame_dt is
+    passed in (physics_constants.FIXED_DT) so it always matches the caller's accumulator. With many spheres
+    the BVH is rebuilt once per frame and only refit on the other sub-steps. Pairs are resolved
+    in order against the current positions, so resolving one pair may already separate a
+    later one.
+
+    order, nodes (rows: left, right, first, count), center, radius, key and stack are
+    caller-owned BVH scratch arrays with room for at least N spheres, 2 * N nodes and
+    physics_constants.BVH_STACK_SIZE stack entries. They are reused across calls, so a step allocates nothing.
+    """
+    use_bvh = pos.shape[0] >= BVH_MIN_SPHERES
+    left = nodes[0]
+    right = nodes[1]
+    first = nodes[2]
+    count = nodes[3]
+    num_nodes = 0
+    sub_dt = frame_dt / NUM_SUB_STEPS
+
+    for sub in range(num_frames * NUM_SUB_STEPS):
+        integrate(pos, vel, sub_dt)
+        wall_bounce(pos, vel, radii, bmin, bmax, WALL_DAMPING)
+        if use_bvh:
+            if sub % NUM_SUB_STEPS == 0:
+                num_nodes = bvh_build(pos, order, left, right, first, count, key, stack)
+            bvh_refit(pos, radii, order, left, right, first, count, center, radius, num_nodes)
+            collide_bvh(pos, vel, radii, inv_mass, order, left, right, first, count, center, radius, stack)
+        else:
+            collide_all_pairs(pos, vel, radii, inv_mass)
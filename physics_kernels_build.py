@@ -0,0 +1,35 @@
+# physics_kernels_build.py
+# Ahead-of-time compiles the simulation kernel into a C extension (_physics_kernels_aot),
+# so deployments skip the Numba JIT warm-up on the first step.
+# Run once at build time:  python physics_kernels_build.py
+# physics.py uses the extension when it is importable and was built from the current kernel
+# source (kernels_version), and falls back to the JIT kernel otherwise.
+import os
+
+from numba.pycc import CC
+
+from physics_constants import kernels_version
+from physics_kernels import simulate_substeps as _simulate_substeps
+
+cc = CC('_physics_kernels_aot')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+_KERNELS_VERSION = kernels_version() # Frozen into the extension at build time
+
+
+@cc.export('kernels_version', 'i8()')
+def export_kernels_version():
+    return _KERNELS_VERSION
+
+
+@cc.export('simulate_substeps',
+           'void(f8[:,::1], f8[:,::1], f8[::1], f8[::1], i8, f8, f8[::1], f8[::1], i8[::1], i8[:,::1], f8[:,::1], '
+           'f8[::1], f8[::1], i8[::1])')
+def simulate_substeps(pos, vel, radii, inv_mass, num_frames, frame_dt, bmin, bmax, order, nodes, center, radius,
+                      key, stack):
+    _simulate_substeps(pos, vel, radii, inv_mass, num_frames, frame_dt, bmin, bmax, order, nodes, center, radius,
+                       key, stack)
+
+
+if __name__ == '__main__':
+    cc.compile()
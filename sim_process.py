@@ -0,0 +1,157 @@
+# sim_process.py
+# Runs the physics simulation in its own process so the physics loop and the Flask
+# request handlers never compete for the same GIL. The published state travels back
+# through a shared memory block; add/delete/reset commands travel over a queue.
+import atexit
+import json
+import multiprocessing as mp
+import threading
+import time
+import traceback
+from multiprocessing import shared_memory
+
+from physics import Simulation
+
+STATE_BUFFER_SIZE = 16 * 1024 * 1024 # Bytes reserved for the published JSON state
+_LENGTH_BYTES = 8 # Header holding the length of the JSON document that follows
+
+
+def _write_state(shm, lock, state_json: bytes) -> bool:
+    """Copies a published state document into the shared block. Returns False if it does not fit."""
+    end = _LENGTH_BYTES + len(state_json)
+    if end > shm.size:
+        return False
+    with lock:
+        shm.buf[_LENGTH_BYTES:end] = state_json
+        shm.buf[:_LENGTH_BYTES] = len(state_json).to_bytes(_LENGTH_BYTES, 'little')
+    return True
+
+
+def _forward_commands(commands, simulation):
+    """Moves commands from the inter-process queue onto the simulation's own queue.
+
+    Runs on a helper thread, so the physics loop never blocks on (or unpickles from) the
+    multiprocessing queue; step() just drains a deque.
+    """
+    while True:
+        op, payload = commands.get()
+        simulation.queue_command(op, payload)
+
+
+def _run_simulation(shm_name, lock, commands, running, bounds_min, bounds_max):
+    """Entry point of the physics process: step (applying queued commands) and publish, at ~60 Hz."""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    simulation = Simulation(bounds_min, bounds_max)
+    threading.Thread(target=_forward_commands, args=(commands, simulation), daemon=True).start()
+    print("Simulation process started.")
+    fits = True # Logs an oversized state once, not on every frame
+    try:
+        while running.is_set():
+            start_time = time.monotonic()
+            simulation.step()
+            published = _write_state(shm, lock, simulation.get_state_json())
+            if fits and not published:
+                print("Simulation process: state does not fit in the shared buffer, not published.")
+            fits = published
+
+            end_time = time.monotonic()
+            sleep_time = (1.0 / 60.0) - (end_time - start_time)
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+    except Exception:
+        # Nothing else would report it: the web process only sees the state stop changing
+        traceback.print_exc()
+        print("Simulation process: step failed, stopping.")
+    finally:
+        shm.close()
+    print("Simulation process stopped.")
+
+
+class SimulationProcess:
+    """Web-process handle on a simulation running in a child process.
+
+    Mirrors the parts of the Simulation API used by app.py. Sphere ids are allocated in
+    this process only (Sphere._id_counter), so it also tracks which ids are alive and can
+    answer deletes without a round trip to the physics process.
+
+    start() is called by app.py's __main__ block, and on the first API request when the app is
+    imported by `flask run` or a WSGI server instead.
+    """
+
+    def __init__(self, bounds_min, bounds_max):
+        self.bounds_min = bounds_min
+        self.bounds_max = bounds_max
+        self._lock = mp.Lock() # Guards the shared state block
+        self._commands = mp.Queue()
+        self._running = mp.Event()
+        self._process = None
+        self._live_ids = set()
+        self._start_lock = threading.Lock() # Request threads may race to start the process
+        empty_state = {"spheres": [], "bounds": {'min': bounds_min.to_list(), 'max': bounds_max.to_list()}}
+        self._empty_state_json = json.dumps(empty_state, separators=(',', ':')).encode()
+        # Allocated in start(), not here: under the spawn/forkserver start methods the child
+        # re-imports the main module, and a block created at import time would leak
+        self._shm = None
+
+    def start(self):
+        """Starts the physics process. Does nothing if it was already started (even if it has died since)."""
+        with self._start_lock:
+            if self._process:
+                return
+            shm = shared_memory.SharedMemory(create=True, size=STATE_BUFFER_SIZE)
+            # Served until the physics process publishes its first step
+            _write_state(shm, self._lock, self._empty_state_json)
+            self._shm = shm
+            self._running.set()
+            self._process = mp.Process(
+                target=_run_simulation,
+                args=(self._shm.name, self._lock, self._commands, self._running, self.bounds_min, self.bounds_max),
+                daemon=True,
+            )
+            self._process.start()
+            atexit.register(self.stop) # Unlinks the shared block if stop() is never called explicitly
+
+    def is_alive(self) -> bool:
+        """Returns False if the physics process was never started or has exited (e.g. a step raised)."""
+        return self._process is not None and self._process.is_alive()
+
+    def stop(self, timeout: float = 1.0):
+        self._running.clear()
+        if self._process:
+            self._process.join(timeout=timeout)
+            self._process = None
+        if self._shm:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def get_state_json(self) -> bytes:
+        """Returns the last state document published by the physics process."""
+        if self._shm is None:
+            return self._empty_state_json
+        with self._lock:
+            length = int.from_bytes(self._shm.buf[:_LENGTH_BYTES], 'little')
+            return bytes(self._shm.buf[_LENGTH_BYTES:_LENGTH_BYTES + length])
+
+    def add_sphere(self, sphere):
+        """Queues a pre-created sphere object for the physics process."""
+        # Note: Assumes this is called within a lock in app.py
+        self._live_ids.add(sphere.id)
+        self._commands.put(('add', sphere))
+
+    def remove_sphere_by_id(self, sphere_id: int) -> bool:
+        """Queues the removal of a sphere. Returns False if no sphere with this id exists."""
+        # Note: Assumes this is called within a lock in app.py
+        if sphere_id not in self._live_ids:
+            return False
+        self._live_ids.discard(sphere_id)
+        self._commands.put(('delete', sphere_id))
+        return True
+
+    def reset(self):
+        """Builds the reset simulation here (allocating its sphere ids) and hands it to the physics process."""
+        # Note: Assumes this is called within a lock in app.py
+        simulation = Simulation(self.bounds_min, self.bounds_max)
+        simulation.reset()
+        self._live_ids = set(simulation.ids.tolist())
+        self._commands.put(('reset', simulation))